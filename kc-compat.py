@@ -1,13 +1,13 @@
-from __future__ import print_function
+import base64
+import socket
+import json
+import re
 import struct
 import sys
 import os
+import time
 
-try:
-    from urllib.request import urlopen
-    from urllib.error import HTTPError, URLError
-except ImportError:
-    from urllib2 import urlopen, HTTPError, URLError
+from hashlib import sha1
 
 __author__ = 'Igor Seletskiy'
 __copyright__ = "Copyright (c) Cloud Linux GmbH & Cloud Linux Software, Inc"
@@ -19,8 +19,8 @@ __status__ = 'Production'
 __version__ = '1.0'
 
 
-SUPPORTED_DISTROS = {
-    "almalinux", 
+SUPPORTED_DISTROS = frozenset((
+    "almalinux",
     "amzn",
     "centos",
     "cloudlinux",
@@ -29,30 +29,93 @@ SUPPORTED_DISTROS = {
     "raspbian",
     "rhel",
     "rocky",
-    "ubuntu", 
+    "ubuntu",
     "proxmox",
-}
+))
+
+PATCHES_HOST = 'patches.kernelcare.com'
+HTTP_TIMEOUT = 5
+
+CACHE_FILE = os.path.expanduser('~/.cache/kernelcare/compat.json')
+CACHE_TTL = 24 * 60 * 60
+
+FLAGS = frozenset(('--silent', '-q', '--report', '--batch', '--no-cache'))
+
+KERNEL_HASH_RE = re.compile(r'[0-9a-f]{40}')
+
+OS_RELEASE_RE = re.compile(br'^(ID|VERSION_ID)=["\']?([^"\'\n]*)', re.MULTILINE)
+
+_connection = None
+_container = None
+
+
+class URLError(IOError):
+    """
+    Patches server can't be reached; mirrors urllib.error.URLError without importing urllib
+    """
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class HTTPError(URLError):
+    """
+    Patches server answered with unexpected HTTP status
+    """
+    def __init__(self, code, reason):
+        super().__init__(reason)
+        self.code = code
 
 
 def get_kernel_hash_from_data(version_data):
-    try:
-        # noinspection PyCompatibility
-        from hashlib import sha1
-    except ImportError:
-        from sha import sha as sha1
     return sha1(version_data).hexdigest()
 
 
+def read_proc_file(path, size=8192):
+    """
+    Read procfs file with a single read(2), so its content can't change between reads
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
 def inside_vz_container():
     """
     determines if we are inside Virtuozzo container
     :return: True if inside container, false otherwise
     """
-    return os.path.exists('/proc/vz/veinfo') and not os.path.exists('/proc/vz/version')
+    try:
+        os.stat('/proc/vz/veinfo')
+    except OSError:
+        return False
+    try:
+        os.stat('/proc/vz/version')
+    except OSError:
+        return True
+    return False
 
 
 def inside_lxc_container():
-    return '/lxc/' in open('/proc/1/cgroup').read()
+    return b'/lxc/' in read_proc_file('/proc/1/cgroup')
+
+
+def detect_container():
+    """
+    determines which container we are inside; it can't change during process lifetime, so result is memoized
+    :return: 'vz', 'lxc' or None if not inside container
+    """
+    global _container
+    if _container is None:
+        if inside_vz_container():
+            _container = 'vz'
+        elif inside_lxc_container():
+            _container = 'lxc'
+        else:
+            _container = ''
+    return _container or None
 
 
 def get_distro_info():
@@ -60,48 +123,177 @@ def get_distro_info():
     Get current distribution name and version
     :return: tuple of (distro_name, distro_version) or (None, None) if detection fails
     """
-    
-    def parse_value(line):
-        return line.split('=', 1)[1].strip().strip('"\'')
-    
-    os_release_path = '/etc/os-release'
-    if not os.path.exists(os_release_path):
-        return None, None
-
     try:
-        distro_name = None
-        distro_version = None
-        with open(os_release_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('ID='):
-                    distro_name = parse_value(line)
-                elif line.startswith('VERSION_ID='):
-                    distro_version = parse_value(line)
-        return distro_name, distro_version
+        with open('/etc/os-release', 'rb') as f:
+            data = f.read()
     except (IOError, OSError):
         return None, None
 
+    values = dict(OS_RELEASE_RE.findall(data))
+    distro_name = values.get(b'ID', b'').decode('utf-8', 'replace').strip() or None
+    distro_version = values.get(b'VERSION_ID', b'').decode('utf-8', 'replace').strip() or None
+    return distro_name, distro_version
+
 
 def is_distro_supported(distro_name):
     """
     Check if the given distro name is supported
+    SUPPORTED_DISTROS is a frozenset and can't be modified at runtime
     """
     return distro_name in SUPPORTED_DISTROS
 
 
+def get_proxy():
+    """
+    Get http proxy for the patches server from environment (http_proxy, no_proxy), same as urlopen does
+    :return: tuple of (host, port, headers) or None if proxy is not used
+    """
+    from urllib.parse import unquote, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+
+    proxy = getproxies().get('http')
+    if not proxy or proxy_bypass(PATCHES_HOST):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parts = urlsplit(proxy)
+    headers = {}
+    if parts.username:
+        credentials = '%s:%s' % (unquote(parts.username), unquote(parts.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return parts.hostname, parts.port, headers
+
+
+def get_connection():
+    """
+    Get keep-alive connection to the patches server or http proxy, shared by all checks in the process
+    :return: tuple of (connection, prefix for request paths, extra request headers)
+    """
+    global _connection
+    if _connection is None:
+        from http.client import HTTPConnection
+        proxy = get_proxy()
+        if proxy:
+            host, port, headers = proxy
+            # proxy expects absolute URL in the request line
+            _connection = (HTTPConnection(host, port, timeout=HTTP_TIMEOUT), f'http://{PATCHES_HOST}', headers)
+        else:
+            _connection = (HTTPConnection(PATCHES_HOST, timeout=HTTP_TIMEOUT), '', {})
+    return _connection
+
+
 def is_compat(kernel_hash):
-    url = 'http://patches.kernelcare.com/' + kernel_hash + '/version'
+    from http.client import HTTPException
+
+    path = f'/{kernel_hash}/version'
+    conn, path_prefix, headers = get_connection()
+    for attempt in range(2):
+        try:
+            conn.request('HEAD', path_prefix + path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            break
+        except (HTTPException, socket.error) as e:
+            conn.close()
+            # server may have dropped an idle keep-alive connection, reconnect once
+            if attempt or isinstance(e, socket.timeout):
+                raise URLError(e)
+
+    if response.status == 404:
+        return False
+    # redirects are not followed: only a direct 2xx answer means the kernel is known
+    if not 200 <= response.status < 300:
+        raise HTTPError(response.status, response.reason)
+    return True
+
+
+def load_cache():
+    """
+    Load cached verdicts, dropping the ones older than CACHE_TTL
+    :return: dict of {kernel_hash: [verdict, timestamp]}, empty if cache is missing or broken
+    """
     try:
-        urlopen(url)
-        return True
-    except HTTPError as e:
-        if e.code == 404:
-            return False
-        else:
-            raise
-    except URLError:
-        raise
+        with open(CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    now = time.time()
+    return dict((k, v) for k, v in cache.items()
+                if isinstance(v, list) and len(v) == 2 and isinstance(v[0], bool)
+                and isinstance(v[1], (int, float)) and not isinstance(v[1], bool)
+                and 0 <= now - v[1] < CACHE_TTL)
+
+
+def save_cache(cache):
+    """
+    Atomically replace the cache file; failing to write the cache is not an error
+    """
+    tmp_path = CACHE_FILE + '.%d.tmp' % os.getpid()
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, CACHE_FILE)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except (IOError, OSError):
+            pass
+
+
+def are_compat(kernel_hashes, use_cache=True):
+    """
+    Check several kernel hashes over the same keep-alive connection,
+    answering from the on-disk cache when a fresh verdict is there;
+    with use_cache=False cached verdicts are ignored, but new ones are still saved over them;
+    a failed check doesn't stop the others and is not cached
+    :return: dict of {kernel_hash: True/False, or URLError if the check failed}
+    """
+    cache = load_cache()
+    results = {}
+    updated = False
+    for kernel_hash in kernel_hashes:
+        if use_cache and kernel_hash in cache:
+            results[kernel_hash] = cache[kernel_hash][0]
+            continue
+        try:
+            results[kernel_hash] = is_compat(kernel_hash)
+        except URLError as e:
+            results[kernel_hash] = e
+            continue
+        cache[kernel_hash] = [results[kernel_hash], time.time()]
+        updated = True
+    if updated:
+        save_cache(cache)
+    return results
+
+
+def cached_is_compat(kernel_hash, use_cache=True):
+    result = are_compat([kernel_hash], use_cache)[kernel_hash]
+    if isinstance(result, URLError):
+        raise result
+    return result
+
+
+def read_batch_file(path):
+    """
+    Read kernel hashes from file, one per line; blank lines and # comments are skipped
+    :return: tuple of (kernel_hashes, invalid_lines), only lowercase hex SHA-1 hashes are accepted
+    """
+    kernel_hashes = []
+    invalid_lines = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if KERNEL_HASH_RE.fullmatch(line):
+                kernel_hashes.append(line)
+            else:
+                invalid_lines.append(line)
+    return kernel_hashes, invalid_lines
 
 
 def myprint(silent, message):
@@ -109,43 +301,99 @@ def myprint(silent, message):
         print(message)
 
 
+def connection_error_message(e):
+    if isinstance(e, HTTPError):
+        return "CONNECTION ERROR; HTTP %d" % e.code
+    return "CONNECTION ERROR; %s" % str(e.reason)
+
+
+def batch_main(path, use_cache=True, silent=False):
+    """
+    Print COMPATIBLE, NEEDS REVIEW or CONNECTION ERROR for every kernel hash listed in the file,
+    and INVALID HASH for lines that are not kernel hashes (those are never checked)
+    exit with 0 if all of them are COMPATIBLE, 1 if some need review, 3 if some couldn't be checked,
+    6 if the file has invalid lines or no kernel hashes at all
+    """
+    try:
+        kernel_hashes, invalid_lines = read_batch_file(path)
+        results = are_compat(kernel_hashes, use_cache)
+    except (IOError, OSError) as e:
+        myprint(silent, "SYSTEM ERROR; %s" % str(e))
+        return 4
+    except Exception as e:
+        myprint(silent, "UNEXPECTED ERROR; %s" % str(e))
+        return 5
+
+    for line in invalid_lines:
+        myprint(silent, "%s INVALID HASH" % line)
+    if not kernel_hashes:
+        myprint(silent, "USAGE ERROR; no kernel hashes in %s" % path)
+        return 6
+    for kernel_hash, result in results.items():
+        if isinstance(result, URLError):
+            message = connection_error_message(result)
+        else:
+            message = "COMPATIBLE" if result else "NEEDS REVIEW"
+        myprint(silent, "%s %s" % (kernel_hash, message))
+
+    if invalid_lines:
+        return 6
+    if any(isinstance(result, URLError) for result in results.values()):
+        return 3
+    return 0 if all(results.values()) else 1
+
+
 def main():
     """
     if --silent or -q argument provided, don't print anything, just use exit code
-    if --report provided, show system information for support
+    if --report provided, show system information for support; report always asks the server
+    if --batch FILE provided, check kernel hashes listed in FILE instead of the running kernel
+    if --no-cache provided, ask the server instead of using verdicts cached for 24 hours, and cache the new verdict
     otherwise print results (COMPATIBLE or support contact messages)
-    else exit with 0 if COMPATIBLE, 1 or more otherwise
+    else exit with 0 if COMPATIBLE, 1 or more otherwise; 6 if --batch is given without FILE
     """
-    silent = len(sys.argv) > 1 and (sys.argv[1] == '--silent' or sys.argv[1] == '-q')
-    report = len(sys.argv) > 1 and sys.argv[1] == '--report'
+    args = sys.argv[1:]
+    flags = set(arg for arg in args if arg in FLAGS)
+    silent = '--silent' in flags or '-q' in flags
+    report = '--report' in flags
+    use_cache = '--no-cache' not in flags
+
+    if '--batch' in flags:
+        batch_index = args.index('--batch') + 1
+        if batch_index >= len(args) or args[batch_index].startswith('-'):
+            myprint(silent, "USAGE ERROR; --batch requires FILE")
+            return 6
+        return batch_main(args[batch_index], use_cache, silent)
 
-    if inside_vz_container() or inside_lxc_container():
+    if detect_container():
         myprint(silent, "UNSUPPORTED; INSIDE CONTAINER")
         return 2
 
     try:
-        with open('/proc/version', 'rb') as f:
-            version_data = f.read()
+        version_data = read_proc_file('/proc/version')
     except (IOError, OSError):
         version_data = b''
     
     kernel_hash = get_kernel_hash_from_data(version_data)
-    distro_name, distro_version = get_distro_info()
 
     if report:
+        distro_name, distro_version = get_distro_info()
         print("=== KernelCare Compatibility Report ===")
         print(f"Kernel Hash: {kernel_hash}")
         print(f"Distribution: {distro_name or 'Unknown'}")
         print(f"Version: {distro_version or 'Unknown'}")
         print(f"Kernel: {version_data.decode('utf-8', errors='replace').strip()}")
         print("=====================================")
-    
+
     try:
-        if is_compat(kernel_hash):
+        if cached_is_compat(kernel_hash, use_cache and not report):
             myprint(silent, "COMPATIBLE")
             return 0
         else:
             # Handle 404 case - check if distro is supported
+            # distro is only needed here, so it is not detected before the network check
+            if not report:
+                distro_name, distro_version = get_distro_info()
             if distro_name and is_distro_supported(distro_name):
                 myprint(silent, "NEEDS REVIEW")
                 myprint(silent, "We support your distribution, but we're having trouble detecting your precise kernel configuration. Please, contact CloudLinux Inc. support by email at support@cloudlinux.com or by request form at https://www.cloudlinux.com/index.php/support")